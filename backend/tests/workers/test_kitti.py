@@ -0,0 +1,281 @@
+import io
+import os
+import struct
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from workers.lib.messenger import messenger
+from workers.lib.vod_converter import kitti
+from workers.lib.vod_converter.kitti import KITTIIngestor, KITTIEgestor
+
+
+class Task:
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        self.messages.append(msg)
+
+
+@pytest.fixture
+def task():
+    current_task = Task()
+    messenger.connect_task(current_task)
+    yield current_task
+    messenger.connect_task(None)
+
+
+def create_kitti_dataset(root, labels):
+    os.makedirs(os.path.join(root, "images"))
+    os.makedirs(os.path.join(root, "labels"))
+    with open(os.path.join(root, "train.txt"), "w") as f:
+        f.write("\n".join(labels.keys()) + "\n")
+    for image_id, label_rows in labels.items():
+        Image.new("RGB", (64, 48)).save(os.path.join(root, "images", f"{image_id}.png"))
+        with open(os.path.join(root, "labels", f"{image_id}.txt"), "wb") as f:
+            f.write(label_rows)
+
+
+class TestKITTIRoundTrip:
+
+    def test_multi_word_label(self, tmpdir, task):
+        detection = {
+            "id": "000001",
+            "image_id": "000001",
+            "label": "traffic light",
+            "left": 1.0,
+            "right": 10.0,
+            "top": 2.0,
+            "bottom": 20.0,
+            "area": None,
+            "segmentation": None,
+            "isbbox": True,
+            "iscrowd": False,
+            "keypoints": []
+        }
+        src = str(tmpdir.join("src"))
+        create_kitti_dataset(src, {"000001": b""})
+        image_detections = KITTIIngestor().ingest(src, None)
+        image_detections[0]["detections"] = [detection]
+
+        dst = str(tmpdir.join("dst"))
+        KITTIEgestor().egest(image_detections=image_detections, root=dst, folder_names=None)
+        round_trip = KITTIIngestor().ingest(dst, None)
+
+        assert len(round_trip) == 1
+        assert round_trip[0]["detections"] == [detection]
+
+
+class TestKITTIEgestor:
+
+    def test_egest_ingest_iter(self, tmpdir, task):
+        src = str(tmpdir.join("src"))
+        create_kitti_dataset(src, {
+            "000001": b"Car 0.0 0 -1 1.0 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n",
+            "000002": b""
+        })
+
+        dst = str(tmpdir.join("dst"))
+        KITTIEgestor().egest(image_detections=KITTIIngestor().ingest_iter(src, None), root=dst, folder_names=None)
+
+        with open(os.path.join(dst, "train.txt")) as f:
+            assert f.read() == "000001\n000002\n"
+        assert sorted(os.listdir(os.path.join(dst, "labels"))) == ["000001.txt", "000002.txt"]
+        with open(os.path.join(dst, "labels", "000001.txt")) as f:
+            assert f.read() == "Car 0.0 0 -1 1.0 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n"
+
+    def test_egest_skips_missing_image(self, tmpdir, task):
+        src = str(tmpdir.join("src"))
+        create_kitti_dataset(src, {"000001": b"", "000002": b"", "000003": b""})
+        image_detections = KITTIIngestor().ingest(src, None)
+        os.remove(os.path.join(src, "images", "000002.png"))
+
+        dst = str(tmpdir.join("dst"))
+        KITTIEgestor().egest(image_detections=iter(image_detections), root=dst, folder_names=None)
+
+        with open(os.path.join(dst, "train.txt")) as f:
+            assert f.read() == "000001\n000003\n"
+        assert sorted(os.listdir(os.path.join(dst, "images"))) == ["000001.png", "000003.png"]
+        assert sorted(os.listdir(os.path.join(dst, "labels"))) == ["000001.txt", "000003.txt"]
+        assert isinstance(task.messages[-1], FileNotFoundError)
+
+
+class TestKITTIValidate:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        kitti._validate_cache.clear()
+        yield
+        kitti._validate_cache.clear()
+
+    @pytest.fixture
+    def clock(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(kitti.time, "monotonic", lambda: now[0])
+        return now
+
+    def test_success_is_cached_until_ttl(self, tmpdir, clock):
+        root = str(tmpdir)
+        create_kitti_dataset(root, {"000001": b""})
+        assert KITTIIngestor().validate(root, None) == (True, None)
+
+        os.remove(os.path.join(root, "train.txt"))
+        clock[0] += kitti.VALIDATE_CACHE_TTL - 1
+        assert KITTIIngestor().validate(root, None) == (True, None)
+
+        clock[0] += 1
+        assert KITTIIngestor().validate(root, None)[0] is False
+        assert root not in kitti._validate_cache
+
+    def test_failure_is_not_cached(self, tmpdir, clock):
+        root = str(tmpdir)
+        assert KITTIIngestor().validate(root, None)[0] is False
+
+        create_kitti_dataset(root, {"000001": b""})
+        assert KITTIIngestor().validate(root, None) == (True, None)
+
+    def test_evicts_least_recently_validated(self, tmpdir, clock, monkeypatch):
+        monkeypatch.setattr(kitti, "VALIDATE_CACHE_SIZE", 2)
+        roots = [str(tmpdir.join(name)) for name in ("a", "b", "c")]
+        for root in roots:
+            create_kitti_dataset(root, {"000001": b""})
+
+        KITTIIngestor().validate(roots[0], None)
+        KITTIIngestor().validate(roots[1], None)
+        KITTIIngestor().validate(roots[0], None)
+        KITTIIngestor().validate(roots[2], None)
+
+        assert list(kitti._validate_cache) == [roots[0], roots[2]]
+
+
+class TestKITTIIngestor:
+
+    def test_undecodable_label_file_skips_image(self, tmpdir, task):
+        root = str(tmpdir)
+        create_kitti_dataset(root, {
+            "000001": b"Car 0.0 0 -1 1.0 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n",
+            "000002": b"Caf\xe9 0.0 0 -1 1.0 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n"
+        })
+        image_detections = KITTIIngestor().ingest(root, None)
+
+        assert [image_detection["image"]["id"] for image_detection in image_detections] == ["000001"]
+        assert "skipped 1 images" in task.messages[-1]
+
+    @staticmethod
+    def _write_labels(tmpdir, data):
+        path = tmpdir.join("labels.txt")
+        path.write_binary(data)
+        return str(path)
+
+    def test_detections_arrays_loadtxt(self, tmpdir, task, monkeypatch):
+        def fail(lines):
+            raise AssertionError("fell back to row by row parsing")
+        monkeypatch.setattr(KITTIIngestor, "_parse_detections_arrays", staticmethod(fail))
+        path = self._write_labels(tmpdir, b"Car 0.0 0 -1 1.0 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n\n"
+                                          b"Van 0.0 0 -1 3.0 4.0 5.0 6.0 -1 -1 -1 -1 -1 -1 -1\n")
+
+        labels, bboxes = KITTIIngestor()._get_detections_arrays(path)
+
+        assert labels == ["Car", "Van"]
+        assert bboxes.dtype == np.float32
+        assert bboxes.tolist() == [[1.0, 2.0, 10.0, 20.0], [3.0, 4.0, 5.0, 6.0]]
+
+    def test_detections_arrays_malformed_rows(self, tmpdir, task):
+        path = self._write_labels(tmpdir, b"Car 0.0 0 -1 1.0 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n"
+                                          b"Bad 0.0 0 -1 x 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n"
+                                          b"Short 0.0 0\n"
+                                          b"Van 0.0 0 -1 3.0 4.0 5.0 6.0 -1 -1 -1 -1 -1 -1 -1\n")
+
+        labels, bboxes = KITTIIngestor()._get_detections_arrays(path)
+
+        assert labels == ["Car", "Van"]
+        assert bboxes.tolist() == [[1.0, 2.0, 10.0, 20.0], [3.0, 4.0, 5.0, 6.0]]
+        assert len(task.messages) == 2
+
+    def test_detections_arrays_quoted_label(self, tmpdir, task):
+        path = self._write_labels(tmpdir, b'"traffic light" 0.0 0 -1 1.0 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n')
+
+        labels, bboxes = KITTIIngestor()._get_detections_arrays(path)
+
+        assert labels == ["traffic light"]
+        assert bboxes.tolist() == [[1.0, 2.0, 10.0, 20.0]]
+
+    def test_quoted_label_repeated_spaces(self, tmpdir, task):
+        path = self._write_labels(tmpdir, b'"traffic light"  0.0  0 -1  1.0 2.0 10.0  20.0\n')
+
+        assert list(KITTIIngestor()._get_detections(path, "000001")) == [
+            kitti.Detection("000001", "traffic light", 1.0, 10.0, 2.0, 20.0)
+        ]
+        assert task.messages == []
+
+    def test_detections_arrays_degenerate_boxes(self, tmpdir, task):
+        path = self._write_labels(tmpdir, b"Car 0.0 0 -1 1.0 2.0 10.0 20.0 -1 -1 -1 -1 -1 -1 -1\n"
+                                          b"Flat 0.0 0 -1 1.0 2.0 10.0 2.0 -1 -1 -1 -1 -1 -1 -1\n"
+                                          b"Thin 0.0 0 -1 5.0 2.0 5.0 20.0 -1 -1 -1 -1 -1 -1 -1\n")
+
+        labels, bboxes = KITTIIngestor()._get_detections_arrays(path)
+        assert labels == ["Car"]
+        assert bboxes.tolist() == [[1.0, 2.0, 10.0, 20.0]]
+
+        labels, bboxes = KITTIIngestor()._get_detections_arrays(path, filter_degenerate=False)
+        assert labels == ["Car", "Flat", "Thin"]
+        assert bboxes.shape == (3, 4)
+
+    def test_detections_arrays_empty_file(self, tmpdir, task):
+        labels, bboxes = KITTIIngestor()._get_detections_arrays(self._write_labels(tmpdir, b"\n"))
+
+        assert labels == []
+        assert bboxes.shape == (0, 4)
+
+
+def encode_image(fmt, **kwargs):
+    buffer = io.BytesIO()
+    Image.new("RGB", (123, 45)).save(buffer, fmt, **kwargs)
+    return buffer.getvalue()
+
+
+def with_exif_segment(jpeg):
+    exif = b"Exif\x00\x00II*\x00\x08\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+    return jpeg[:2] + b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif + jpeg[2:]
+
+
+class TestImageDimensions:
+
+    @pytest.fixture
+    def write_image(self, tmpdir):
+        def write(name, data):
+            path = tmpdir.join(name)
+            path.write_binary(data)
+            return str(path)
+        return write
+
+    @pytest.fixture
+    def without_pil(self, monkeypatch):
+        def fail(path):
+            raise AssertionError(f"fell back to PIL for {path}")
+        monkeypatch.setattr(kitti, "_image_dimensions", fail)
+
+    @pytest.mark.parametrize("name,data", [
+        ("image.png", encode_image("PNG")),
+        ("baseline.jpg", encode_image("JPEG")),
+        ("progressive.jpg", encode_image("JPEG", progressive=True)),
+        ("exif.jpg", with_exif_segment(encode_image("JPEG")))
+    ])
+    def test_reads_header(self, write_image, without_pil, name, data):
+        assert tuple(kitti._fast_image_dimensions(write_image(name, data))) == (123, 45)
+
+    def test_falls_back_to_pil(self, write_image):
+        assert tuple(kitti._fast_image_dimensions(write_image("image.bmp", encode_image("BMP")))) == (123, 45)
+
+    @pytest.mark.parametrize("name,data", [
+        ("empty.png", b""),
+        ("truncated.png", encode_image("PNG")[:20]),
+        ("truncated.jpg", encode_image("JPEG")[:20]),
+        ("zero_length_segment.jpg", b"\xff\xd8\xff\xe0\x00\x00")
+    ])
+    def test_invalid_image(self, write_image, name, data):
+        with pytest.raises(OSError):
+            kitti._fast_image_dimensions(write_image(name, data))
@@ -22,6 +22,21 @@ class Ingestor:
         """
         pass
 
+    def ingest_iter(self, path, folder_names):
+        """
+        Read in data from the filesystem one image detection at a time.
+
+        Formats that can stream their images should override this so that consumers handling one image
+        at a time don't have to hold the whole dataset in memory. By default it iterates over `ingest`.
+
+        Note: the result can only be iterated once. `convert` and `Egestor.egest` expect an array, so wrap the
+        result in `list()` before passing it to them.
+        :param path: '/path/to/data/'
+        :param folder_names: List of folders containing dataset
+        :return: an iterator of dicts conforming to `IMAGE_DETECTION_SCHEMA`
+        """
+        yield from self.ingest(path, folder_names)
+
 
 class Egestor:
     def expected_labels(self):
@@ -29,18 +29,89 @@ each row corresponds to one object. The 15 columns represent:
 """
 
 import csv
+import mmap
 import os
 import shutil
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 
+import numpy as np
 from PIL import Image
 from workers.lib.messenger import message
 
 from .abstract import Ingestor, Egestor
 from .labels_and_aliases import output_labels
 
+LABEL_FILE_BUFFER_SIZE = 1 << 16
+LABEL_FILE_MMAP_THRESHOLD = 1 << 20
+IMAGE_IDS_BUFFER_SIZE = 1 << 20
+IMAGE_IDS_MMAP_THRESHOLD = 50 << 20
+IMAGE_EXTS = ("png", "jpg")
+# Reading labels and image headers is I/O bound, so use more threads than cores
+INGEST_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Paths that passed validation are remembered briefly, so a dataset removed later is noticed within seconds.
+# Failures are never cached. The least recently validated path is evicted first.
+VALIDATE_CACHE_TTL = 5.0
+VALIDATE_CACHE_SIZE = 128
+
+_validate_cache = OrderedDict()
+_validate_cache_lock = threading.Lock()
+
+
+class Detection(NamedTuple):
+    id: str
+    label: str
+    left: float
+    right: float
+    top: float
+    bottom: float
+
+    def as_dict(self):
+        """
+        Expand into a dict conforming to the detection part of `IMAGE_DETECTION_SCHEMA`.
+        """
+        return {
+            "id": self.id,
+            "image_id": self.id,
+            "label": self.label,
+            "left": self.left,
+            "right": self.right,
+            "top": self.top,
+            "bottom": self.bottom,
+            "area": None,
+            "segmentation": None,
+            "isbbox": True,
+            "iscrowd": False,
+            "keypoints": []
+        }
+
 
 class KITTIIngestor(Ingestor):
     def validate(self, path, folder_names):
+        now = time.monotonic()
+        with _validate_cache_lock:
+            validated_at = _validate_cache.get(path)
+            if validated_at is not None:
+                if now - validated_at < VALIDATE_CACHE_TTL:
+                    _validate_cache.move_to_end(path)
+                    return True, None
+                del _validate_cache[path]
+
+        result = self._validate_layout(path)
+        if result[0]:
+            with _validate_cache_lock:
+                _validate_cache[path] = now
+                _validate_cache.move_to_end(path)
+                if len(_validate_cache) > VALIDATE_CACHE_SIZE:
+                    _validate_cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _validate_layout(path):
         expected_dirs = [
             "images",
             "labels"
@@ -53,78 +124,206 @@ class KITTIIngestor(Ingestor):
         return True, None
 
     def ingest(self, path, folder_names):
-        image_ids = self._get_image_ids(path)
-        image_ext = "png"
-        if len(image_ids):
-            first_image_id = image_ids[0]
-            image_ext = self.find_image_ext(path, first_image_id)
-        tmp = [self._get_image_detection(path, image_name, image_ext=image_ext, folder_names=folder_names) for
-               image_name in image_ids]
-        message(f"size: {len(tmp)}")
+        errors = []
+        tmp = list(self.ingest_iter(path, folder_names, errors=errors))
+        message(f"size: {len(tmp)}, skipped {len(errors)} images")
         return tmp
 
+    def ingest_iter(self, path, folder_names, *, errors=None):
+        """
+        Read in data from the filesystem one image detection at a time, in train.txt order.
+
+        Images are read on a thread pool with a bounded number of images in flight, so memory doesn't grow with
+        the size of the dataset.
+
+        Note: the result can only be iterated once. `convert` and `Egestor.egest` expect an array, so wrap the
+        result in `list()` before passing it to them.
+        :param path: '/path/to/data/'
+        :param folder_names: List of folders containing dataset
+        :param errors: optional list collecting the errors of skipped images
+        :return: an iterator of dicts conforming to `IMAGE_DETECTION_SCHEMA`
+        """
+        if errors is None:
+            errors = []
+        image_ids = self._get_image_ids(path)
+        labels_dir = os.path.join(path, "labels")
+        images_dir = os.path.join(path, "images")
+        image_exts = self._get_image_exts(images_dir)
+        with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+            pending = deque()
+            for image_id in image_ids:
+                pending.append(executor.submit(self._get_image_detection, labels_dir, images_dir, image_id,
+                                               image_exts=image_exts, errors=errors, folder_names=folder_names))
+                if len(pending) >= INGEST_WORKERS * 2:
+                    image_detection = pending.popleft().result()
+                    if image_detection is not None:
+                        yield image_detection
+            while pending:
+                image_detection = pending.popleft().result()
+                if image_detection is not None:
+                    yield image_detection
+
     @staticmethod
-    def find_image_ext(root, image_id):
-        for image_ext in ["png", "jpg"]:
-            if os.path.exists(os.path.join(root, "images", f"{image_id}.{image_ext}")):
-                return image_ext
-        raise Exception(f"could not find jpg or png for {image_id} at {os.path.join(root, 'images')}")
+    def _get_image_exts(images_dir):
+        """
+        Map every image id in the images directory to its extension with a single directory scan,
+        preferring png when an image exists as both png and jpg.
+        """
+        image_exts = {}
+        with os.scandir(images_dir) as entries:
+            for entry in entries:
+                image_id, image_ext = os.path.splitext(entry.name)
+                image_ext = image_ext[1:]
+                if image_ext in IMAGE_EXTS and image_exts.get(image_id) != IMAGE_EXTS[0]:
+                    image_exts[image_id] = image_ext
+        return image_exts
 
     @staticmethod
     def _get_image_ids(root):
         path = os.path.join(root, "train.txt")
-        with open(path) as f:
-            return f.read().strip().split("\n")
+        lines = _iter_lines(path, buffering=IMAGE_IDS_BUFFER_SIZE, mmap_threshold=IMAGE_IDS_MMAP_THRESHOLD)
+        return [line.decode() for line in map(bytes.strip, lines) if line]
+
+    def _get_image_detection(self, labels_dir, images_dir, image_id, *, image_exts, errors, folder_names):
+        image_ext = image_exts.get(image_id)
+        if image_ext is None:
+            return self._skip_image(errors, f"could not find jpg or png for {image_id} at {images_dir}")
 
-    def _get_image_detection(self, root, image_id, *, image_ext="png", folder_names):
+        detections_fpath = f"{labels_dir}{os.sep}{image_id}.txt"
         try:
-            detections_fpath = os.path.join(root, "labels", f"{image_id}.txt")
-            detections = self._get_detections(detections_fpath, image_id)
-            detections = [det for det in detections if det["left"] < det["right"] and det["top"] < det["bottom"]]
-            image_path = os.path.join(root, "images", f"{image_id}.{image_ext}")
-            image_width, image_height = _image_dimensions(image_path)
-            return {
-                "image": {
-                    "id": image_id,
-                    "dataset_id": None,
-                    "path": image_path,
-                    "segmented_path": None,
-                    "width": image_width,
-                    "height": image_height,
-                    "file_name": f"{image_id}.{image_ext}"
-                },
-                "detections": detections
-            }
-        except Exception as e:
-            message(e)
-
-    def _get_detections(self, detections_fpath, image_id):
-        detections = []
-        with open(detections_fpath) as f:
-            f_csv = csv.reader(f, delimiter=" ")
-            for row in f_csv:
-                if len(row) == 0:
-                    continue
-                try:
-                    x1, y1, x2, y2 = map(float, row[4:8])
-                    label = row[0]
-                    detections.append({
-                        "id": image_id,
-                        "image_id": image_id,
-                        "label": label,
-                        "left": x1,
-                        "right": x2,
-                        "top": y1,
-                        "bottom": y2,
-                        "area": None,
-                        "segmentation": None,
-                        "isbbox": True,
-                        "iscrowd": False,
-                        "keypoints": []
-                    })
-                except ValueError as ve:
-                    message(f"{ve} - {row}")
-        return detections
+            detections = [det.as_dict() for det in self._get_detections(detections_fpath, image_id)]
+        except (OSError, UnicodeDecodeError) as e:
+            return self._skip_image(errors, e)
+
+        image_path = f"{images_dir}{os.sep}{image_id}.{image_ext}"
+        try:
+            image_width, image_height = _fast_image_dimensions(image_path)
+        except OSError as e:
+            return self._skip_image(errors, e)
+
+        return {
+            "image": {
+                "id": image_id,
+                "dataset_id": None,
+                "path": image_path,
+                "segmented_path": None,
+                "width": image_width,
+                "height": image_height,
+                "file_name": f"{image_id}.{image_ext}"
+            },
+            "detections": detections
+        }
+
+    @staticmethod
+    def _skip_image(errors, error):
+        message(error)
+        errors.append(error)
+
+    @staticmethod
+    def _read_label_lines(detections_fpath):
+        lines = _iter_lines(detections_fpath, buffering=LABEL_FILE_BUFFER_SIZE,
+                            mmap_threshold=LABEL_FILE_MMAP_THRESHOLD)
+        return (line for line in map(bytes.strip, lines) if line)
+
+    def _get_detections_arrays(self, detections_fpath, *, filter_degenerate=True):
+        """
+        Struct-of-arrays variant of `_get_detections` for bulk processing, avoiding a dict per detection.
+
+        `ingest` deliberately doesn't use this: a label file has only a handful of rows, and numpy.loadtxt is
+        slower than `_parse_label_line` at that size. This reader is for consumers that want whole arrays.
+
+        :param detections_fpath: '/path/to/labels/<image_id>.txt'
+        :param filter_degenerate: drop boxes with left >= right or top >= bottom
+        :return: (labels, bboxes) where bboxes is an Nx4 float32 array of left, top, right, bottom
+        """
+        lines = list(self._read_label_lines(detections_fpath))
+        if not lines:
+            return [], np.empty((0, 4), dtype=np.float32)
+        if any(line.startswith(b'"') for line in lines):
+            # loadtxt doesn't understand quoted labels, they would shift every column after them
+            labels, bboxes = self._parse_detections_arrays(lines)
+        else:
+            labels, bboxes = self._load_detections_arrays(lines)
+        if filter_degenerate:
+            mask = (bboxes[:, 0] < bboxes[:, 2]) & (bboxes[:, 1] < bboxes[:, 3])
+            labels = [label for label, keep in zip(labels, mask) if keep]
+            bboxes = bboxes[mask]
+        return labels, bboxes
+
+    def _load_detections_arrays(self, lines):
+        try:
+            columns = np.loadtxt([line.decode(errors="replace") for line in lines], dtype=str,
+                                 usecols=(0, 4, 5, 6, 7), ndmin=2, comments=None)
+            labels = columns[:, 0].tolist()
+            bboxes = columns[:, 1:].astype(np.float32)
+        except (ValueError, IndexError):
+            # Fall back to parsing row by row, so only the malformed rows get reported and dropped
+            labels, bboxes = self._parse_detections_arrays(lines)
+        return labels, bboxes
+
+    @staticmethod
+    def _parse_detections_arrays(lines):
+        labels = []
+        coords = []
+        for line in lines:
+            try:
+                label, x1, y1, x2, y2 = _parse_label_line(line, errors="replace")
+            except (ValueError, IndexError) as e:
+                message(f"{e} - {line.decode(errors='replace')}")
+                continue
+            labels.append(label)
+            coords.append((x1, y1, x2, y2))
+        return labels, np.array(coords, dtype=np.float32).reshape(-1, 4)
+
+    def _get_detections(self, detections_fpath, image_id, *, filter_degenerate=True):
+        for line in self._read_label_lines(detections_fpath):
+            try:
+                label, x1, y1, x2, y2 = _parse_label_line(line)
+            except UnicodeDecodeError:
+                # Not a malformed row but an undecodable file, let the caller skip the whole image
+                raise
+            except (ValueError, IndexError) as e:
+                message(f"{e} - {line.decode(errors='replace')}")
+                continue
+            if filter_degenerate and (x1 >= x2 or y1 >= y2):
+                continue
+            yield Detection(image_id, label, x1, x2, y1, y2)
+
+
+def _parse_label_line(line, errors="strict"):
+    """
+    Parse the label and bbox (left, top, right, bottom) out of a KITTI label line.
+
+    Only the first 8 fields are split off, and each coordinate is converted with its own float() call,
+    which is noticeably cheaper than slicing the row and mapping float over it. Labels containing spaces
+    are quoted the way csv.writer quotes them, so those lines go through the csv module instead.
+    """
+    if line.startswith(b'"'):
+        row = next(csv.reader([line.decode(errors=errors)], delimiter=" ", skipinitialspace=True))
+        return row[0], float(row[4]), float(row[5]), float(row[6]), float(row[7])
+    row = line.split(None, 8)
+    return row[0].decode(errors=errors), float(row[4]), float(row[5]), float(row[6]), float(row[7])
+
+
+def _iter_lines(path, *, buffering, mmap_threshold):
+    """
+    Iterate over the byte lines of a file. Files larger than `mmap_threshold` bytes are mapped into memory
+    and scanned in place, so only one line at a time is copied out instead of the whole file. Lines may keep
+    a trailing carriage return, callers strip them.
+    """
+    with open(path, "rb", buffering=buffering) as f:
+        if os.fstat(f.fileno()).st_size <= mmap_threshold:
+            yield from f.read().splitlines()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            start = 0
+            while start < size:
+                end = mm.find(b"\n", start)
+                if end == -1:
+                    end = size
+                yield mm[start:end]
+                start = end + 1
 
 
 def _image_dimensions(path):
@@ -132,8 +331,86 @@ def _image_dimensions(path):
         return image.width, image.height
 
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SOI = b"\xff\xd8"
+# Start of frame markers, excluding DHT (0xC4), JPG (0xC8) and DAC (0xCC) which share the range
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+def _fast_image_dimensions(path):
+    """
+    Read width and height straight from PNG IHDR / JPEG SOF headers, falling back to PIL for
+    anything else (or anything malformed).
+    """
+    with open(path, "rb", buffering=4096) as f:
+        header = f.read(24)
+        if len(header) == 24 and header[:8] == PNG_SIGNATURE and header[12:16] == b"IHDR":
+            return struct.unpack(">II", header[16:24])
+        if header[:2] == JPEG_SOI:
+            f.seek(2)
+            dimensions = _jpeg_dimensions(f)
+            if dimensions is not None:
+                return dimensions
+    return _image_dimensions(path)
+
+
+def _jpeg_dimensions(f):
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS or marker == 0x00:
+            continue
+        if marker == 0xD9 or marker == 0xDA:
+            # End of image / start of scan without a frame header
+            return None
+        segment = f.read(2)
+        if len(segment) != 2:
+            return None
+        length = struct.unpack(">H", segment)[0]
+        if length < 2:
+            return None
+        if marker in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) != 5:
+                return None
+            height, width = struct.unpack(">xHH", frame)
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
 DEFAULT_TRUNCATED = 0.0  # 0% truncated
 DEFAULT_OCCLUDED = 0  # fully visible
+# Only label and bbox vary per row; alpha, dimensions, location and rotation_y are unknown
+KITTI_ROW_FORMAT = f"{{}} {DEFAULT_TRUNCATED} {DEFAULT_OCCLUDED} -1 {{}} {{}} {{}} {{}} -1 -1 -1 -1 -1 -1 -1\n"
+EGEST_COPY_WORKERS = 8
+
+
+def _copy_image(image, images_dir):
+    src_extension = os.path.splitext(image["path"])[-1]
+    try:
+        # copyfile uses os.sendfile on Linux, so the copy itself stays out of userspace
+        shutil.copyfile(image["path"], f"{images_dir}{os.sep}{image['id']}{src_extension}")
+    except FileNotFoundError as e:
+        return e
+    return None
+
+
+def _quote_label(label):
+    # Quote labels with whitespace the way csv.writer does, so they still read back as a single column
+    if '"' in label or len(label.split()) != 1:
+        return '"' + label.replace('"', '""') + '"'
+    return label
 
 
 class KITTIEgestor(Egestor):
@@ -147,32 +424,25 @@ class KITTIEgestor(Egestor):
         labels_dir = os.path.join(root, "labels")
         os.makedirs(labels_dir, exist_ok=True)
         id_file = os.path.join(root, "train.txt")
+        # Copies and label writing are two passes over the input, so an iterator has to be materialized first
+        image_detections = list(image_detections)
 
-        for image_detection in image_detections:
-            image = image_detection["image"]
-            image_id = image["id"]
-            src_extension = os.path.splitext(image["path"])[-1]
-            try:
-                shutil.copyfile(image["path"], os.path.join(images_dir, f"{image_id}{src_extension}"))
-            except FileNotFoundError as e:
-                message(e)
-                continue
+        with ThreadPoolExecutor(max_workers=EGEST_COPY_WORKERS) as executor:
+            copy_errors = list(executor.map(lambda image_detection: _copy_image(image_detection["image"], images_dir),
+                                            image_detections))
+
+        with open(id_file, "a", buffering=LABEL_FILE_BUFFER_SIZE) as out_image_index_file:
+            for image_detection, copy_error in zip(image_detections, copy_errors):
+                if copy_error is not None:
+                    message(copy_error)
+                    continue
+                image_id = image_detection["image"]["id"]
 
-            with open(id_file, "a") as out_image_index_file:
                 out_image_index_file.write(f"{image_id}\n")
 
-            out_labels_path = os.path.join(labels_dir, f"{image_id}.txt")
-            with open(out_labels_path, "w") as csvfile:
-                csvwriter = csv.writer(csvfile, delimiter=" ", quoting=csv.QUOTE_MINIMAL)
-
-                for detection in image_detection["detections"]:
-                    kitti_row = [-1] * 15
-                    kitti_row[0] = detection["label"]
-                    kitti_row[1] = DEFAULT_TRUNCATED
-                    kitti_row[2] = DEFAULT_OCCLUDED
-                    x1 = detection["left"]
-                    x2 = detection["right"]
-                    y1 = detection["top"]
-                    y2 = detection["bottom"]
-                    kitti_row[4:8] = x1, y1, x2, y2
-                    csvwriter.writerow(kitti_row)
+                out_labels_path = f"{labels_dir}{os.sep}{image_id}.txt"
+                with open(out_labels_path, "w", buffering=LABEL_FILE_BUFFER_SIZE) as out_labels_file:
+                    for detection in image_detection["detections"]:
+                        out_labels_file.write(KITTI_ROW_FORMAT.format(
+                            _quote_label(detection["label"]), detection["left"], detection["top"], detection["right"],
+                            detection["bottom"]))